@@ -1,6 +1,28 @@
+import io
+import gzip
+import json
+import atexit
+import logging
+import sqlite3
+import tempfile
+import copy
+import threading
+from queue import SimpleQueue
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener
+from os import remove, replace
+from sys import stdin
+from math import sqrt
 from os.path import isfile
 from getpass import getpass
 
+GZIP_MAGIC = b'\x1f\x8b'
+LOG_FORMAT = '[%(asctime)s] [%(module)s.%(funcName)s] [%(levelname)s] %(message)s'
+
+_listener = None
+_queue_handler = None
+_listener_lock = threading.Lock()
+
 
 def get_config(file='.access_token'):
     if not isfile(file):
@@ -9,4 +31,370 @@ def get_config(file='.access_token'):
         with open(file, 'r') as f:
             config = f.read()
 
-    return config.strip()
\ No newline at end of file
+    return config.strip()
+
+
+def open_items(file):
+    """
+    Open a file of items for text reading; '-' reads stdin, gzip content is detected and decompressed.
+
+    :param file: Path to the file or '-' for stdin
+    :returns: Text file like object
+    """
+    if file == '-':
+        raw = stdin.buffer
+    else:
+        raw = open(file, 'rb')
+
+    if not isinstance(raw, io.BufferedReader):
+        raw = io.BufferedReader(raw)
+    if raw.peek(2)[:2] == GZIP_MAGIC:
+        raw = gzip.GzipFile(fileobj=raw)
+
+    return io.TextIOWrapper(raw, encoding='utf-8')
+
+
+def iter_lines(file):
+    """
+    Lazily yield the stripped, non empty lines of a file.
+
+    :param file: Path to the file or '-' for stdin
+    :returns: Generator of Strings, one per line
+    """
+    f = open_items(file)
+    try:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+    finally:
+        if file == '-':
+            f.detach()
+        else:
+            f.close()
+
+
+def unique(items, spill_dir='.', batch=10000):
+    """
+    Lazily deduplicate items in bounded memory, preserving first seen order.
+
+    Seen items are kept in a temporary on disk sqlite table in spill_dir rather than
+    in memory, and inserts are committed in batches.
+
+    :param items: Iterable of Strings
+    :param spill_dir: String directory for the temporary table
+    :param batch: Integer number of items per transaction
+    :returns: Generator of the unique Strings
+    """
+    fd, path = tempfile.mkstemp(prefix='jfintegrity-', suffix='.db', dir=spill_dir)
+    with open(fd, 'w'):
+        pass
+    db = sqlite3.connect(path, isolation_level=None)
+    try:
+        db.execute('PRAGMA journal_mode=OFF')
+        db.execute('PRAGMA synchronous=OFF')
+        db.execute('CREATE TABLE seen (item TEXT PRIMARY KEY) WITHOUT ROWID')
+        db.execute('BEGIN')
+        for n, item in enumerate(items, 1):
+            if db.execute('INSERT OR IGNORE INTO seen VALUES (?)', (item,)).rowcount:
+                yield item
+            if not n % batch:
+                db.execute('COMMIT')
+                db.execute('BEGIN')
+        db.execute('COMMIT')
+    finally:
+        db.close()
+        remove(path)
+
+
+def read_snapshot(path):
+    """
+    Read a repository listing snapshot.
+
+    :param path: String path of the snapshot file
+    :returns: Tuple of Dictionary metadata and Generator of Tuples (uri, lastModified, size, sha256)
+    """
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        meta = json.loads(f.readline())
+
+    def records():
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            f.readline()
+            for line in f:
+                uri, last_modified, size, sha2 = line.rstrip('\n').split('\t')
+                yield uri, last_modified, int(size) if size else None, sha2 or None
+
+    return meta, records()
+
+
+def write_snapshot(path, meta, records):
+    """
+    Write a repository listing snapshot atomically, as gzipped JSON metadata followed by tab separated records.
+
+    :param path: String path of the snapshot file
+    :param meta: Dictionary metadata
+    :param records: Iterable of Tuples (uri, lastModified, size, sha256)
+    """
+    tmp = f'{path}.tmp'
+    with gzip.open(tmp, 'wt', encoding='utf-8') as f:
+        f.write(json.dumps(meta) + '\n')
+        for uri, last_modified, size, sha2 in records:
+            f.write(f'{uri}\t{last_modified}\t{"" if size is None else size}\t{sha2 or ""}\n')
+    replace(tmp, path)
+
+
+class LatencyTracker():
+    """A thread safe window of recent request latencies."""
+
+    def __init__(self, window=1000, min_samples=20):
+        """
+        Initialize class.
+
+        :param window: Integer number of most recent latencies to keep
+        :param min_samples: Integer number of latencies needed before percentiles are reported
+        """
+        self.latencies = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+    def add(self, latency):
+        """
+        Record a latency.
+
+        :param latency: Float seconds
+        """
+        with self.lock:
+            self.latencies.append(latency)
+
+    def percentile(self, p):
+        """
+        Get a percentile of the recorded latencies.
+
+        :param p: Float between 0 and 1
+        :returns: Float seconds, or None until min_samples latencies are recorded
+        """
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+
+class Rollup():
+    """Thread safe per repository and per folder counts of results, aggregated as results arrive."""
+
+    def __init__(self, depth=1):
+        """
+        Initialize class.
+
+        :param depth: Integer number of folder levels below the repository to aggregate at
+        """
+        self.depth = depth
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def add(self, artifact, result):
+        """
+        Count a result against the repository and each enclosing folder down to depth.
+
+        :param artifact: String artifact with full path
+        :param result: String result of the artifact
+        """
+        parts = artifact.split('/')
+        with self.lock:
+            for level in range(1, min(self.depth + 1, len(parts) - 1) + 1):
+                counts = self.counts.setdefault('/'.join(parts[:level]), {})
+                counts[result] = counts.get(result, 0) + 1
+
+    def tree(self):
+        """
+        Nest the counts by path.
+
+        :returns: Dictionary keyed by repository of Dictionaries with counts and children keys
+        """
+        tree = {}
+        with self.lock:
+            for path in sorted(self.counts):
+                node = {'children': tree}
+                for name in path.split('/'):
+                    node = node['children'].setdefault(name, {'counts': {}, 'children': {}})
+                node['counts'] = dict(self.counts[path])
+        return tree
+
+    def summary(self):
+        """
+        Describe the counts as indented text, one path per line, walking the tree so children follow their parent.
+
+        :returns: String summary
+        """
+        lines = []
+
+        def walk(children, prefix, level):
+            for name in sorted(children):
+                node = children[name]
+                path = f'{prefix}{name}'
+                counts = ', '.join(f'{result}={count}' for result, count in sorted(node['counts'].items()))
+                lines.append(f'{"  " * level}{path}: {counts}')
+                walk(node['children'], f'{path}/', level + 1)
+
+        walk(self.tree(), '', 0)
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def write(self, json_file, text_file):
+        """
+        Write the report as JSON and as a text summary.
+
+        :param json_file: String path of the JSON report
+        :param text_file: String path of the text summary
+        """
+        with open(json_file, 'w') as f:
+            json.dump(self.tree(), f, indent=2)
+        with open(text_file, 'w') as f:
+            f.write(self.summary())
+
+
+def wilson_interval(successes, n, z=1.96, population=None):
+    """
+    Wilson score confidence interval for a binomial proportion.
+
+    With a population size, the finite population correction narrows the interval
+    as the sample covers more of the population, down to the exact rate for a census.
+
+    :param successes: Integer number of positive outcomes
+    :param n: Integer number of trials
+    :param z: Float standard normal quantile, 1.96 for 95% confidence
+    :param population: Integer size of the population sampled without replacement
+    :returns: Tuple of Float lower and upper bounds, (0.0, 1.0) when n is 0
+    """
+    if not n:
+        return 0.0, 1.0
+    if population:
+        if n >= population:
+            return successes / n, successes / n
+        z = z * sqrt((population - n) / (population - 1))
+    p = successes / n
+    denominator = 1 + z ** 2 / n
+    centre = (p + z ** 2 / (2 * n)) / denominator
+    margin = z * sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2)) / denominator
+    return max(0.0, centre - margin), min(1.0, centre + margin)
+
+
+class ExceptionQueueHandler(QueueHandler):
+    """A queue handler that keeps the exception text apart from the message for the listener's formatter."""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Format log records as one JSON object per line."""
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record),
+                 'level': record.levelname,
+                 'module': record.module,
+                 'function': record.funcName,
+                 'thread': record.threadName,
+                 'message': record.getMessage()}
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+
+class BatchFileHandler(logging.FileHandler):
+    """A file handler that flushes every batch records, and at least every interval seconds from a timer thread."""
+
+    def __init__(self, filename, batch=500, interval=1.0, **kwargs):
+        """
+        Initialize class.
+
+        :param filename: String path of the log file
+        :param batch: Integer number of records to buffer before flushing
+        :param interval: Float maximum seconds a record stays buffered
+        """
+        super().__init__(filename, **kwargs)
+        self.batch = batch
+        self.interval = interval
+        self.pending = 0
+        self.stopped = threading.Event()
+        self.timer = threading.Thread(target=self._flush_periodically, daemon=True)
+        self.timer.start()
+
+    def _flush_periodically(self):
+        while not self.stopped.wait(self.interval):
+            if self.pending:
+                self.flush()
+
+    def emit(self, record):
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+            return
+        self.pending += 1
+        if self.pending >= self.batch:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            super().flush()
+            self.pending = 0
+
+    def close(self):
+        self.stopped.set()
+        super().close()
+
+
+def setup_logging(name='logger', file='log', json_format=False):
+    """
+    Attach a queue handler to a logger, once; a background listener does the stream and file output.
+
+    Calling it again only switches the output format, so handlers never pile up.
+
+    :param name: String name of the logger
+    :param file: String path of the log file
+    :param json_format: Boolean whether to write JSON lines instead of plain text
+    :returns: logging.Logger
+    """
+    global _listener, _queue_handler
+    logger = logging.getLogger(name)
+    formatter = JsonFormatter() if json_format else logging.Formatter(LOG_FORMAT)
+    with _listener_lock:
+        if _listener is None:
+            q = SimpleQueue()
+            streamHandler = logging.StreamHandler()
+            fileHandler = BatchFileHandler(file, encoding='utf-8')
+            _listener = QueueListener(q, streamHandler, fileHandler)
+            _queue_handler = ExceptionQueueHandler(q)
+            logger.addHandler(_queue_handler)
+            _listener.start()
+            atexit.register(stop_logging)
+        for handler in _listener.handlers:
+            handler.setFormatter(formatter)
+    return logger
+
+
+def stop_logging():
+    """Detach the queue handler, drain the logging queue and flush and close its handlers."""
+    global _listener, _queue_handler
+    with _listener_lock:
+        if _listener is None:
+            return
+        for logger in logging.Logger.manager.loggerDict.values():
+            if isinstance(logger, logging.Logger):
+                logger.removeHandler(_queue_handler)
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+        _queue_handler = None
@@ -1,31 +1,68 @@
 """Jfrog artifact integrity checker.
 
 Usage: 
-    jfintegrity.py check [-hvVt THREADS] [--access-token=ACCESS_TOKEN] [--after AFTER_DATE]
-                         [--afile=ART_FILE] [--rfile=REPO_FILE] [--url=URL] [REPO]...
-    jfintegrity.py delete [-hvVt THREADS] [--access-token=ACCESS_TOKEN]
-                          [--url=URL] DEL_FILE
+    jfintegrity.py check [-hvVt THREADS] [--log-json] [--access-token=ACCESS_TOKEN] [--after AFTER_DATE]
+                         [--connect-timeout=SECONDS] [--read-timeout=SECONDS] [--deadline=MINUTES] [--hedge]
+                         [--sample=SAMPLE | --sample-rate=RATE] [--snapshot-dir=DIR [--refresh] | --crawl [--crawl-per-repo=N]]
+                         [--report [--report-depth=DEPTH]] [--resolve-virtual]
+                         [--spill-dir=DIR] [--afile=ART_FILE] [--rfile=REPO_FILE] [--url=URL] [REPO]...
+    jfintegrity.py delete [-hvVt THREADS] [--log-json] [--access-token=ACCESS_TOKEN]
+                          [--connect-timeout=SECONDS] [--read-timeout=SECONDS] [--deadline=MINUTES]
+                          [--report [--report-depth=DEPTH]] [--spill-dir=DIR] [--url=URL] DEL_FILE
+    jfintegrity.py plan [-hvVt THREADS] [--log-json] [--access-token=ACCESS_TOKEN] [--after AFTER_DATE] [--delete]
+                        [--connect-timeout=SECONDS] [--read-timeout=SECONDS] [--hedge]
+                        [--snapshot-dir=DIR [--refresh] | --crawl [--crawl-per-repo=N]]
+                        [--samples=SAMPLES] [--window=MINUTES] [--resolve-virtual] [--afile=ART_FILE] [--rfile=REPO_FILE]
+                        [--url=URL] [REPO]...
+    jfintegrity.py compare [-hvVt THREADS] [--log-json] [--access-token=ACCESS_TOKEN] [--after AFTER_DATE]
+                           [--connect-timeout=SECONDS] [--read-timeout=SECONDS] [--deadline=MINUTES] [--hedge]
+                           [--trace-divergent] [--snapshot-dir=DIR [--refresh]] [--rfile=REPO_FILE] [--url=URL] (--peer=PEER)... [REPO]...
 
 Options:
     -h                            Show this screen
     -v                            Show version
     -V                            Verbose output
+    --log-json                    write the log as JSON lines
     -t THREADS --threads=THREADS  specify number of threads [default: 10]
     --url=URL                     specify the base url of the artifactory instance
     --access-token=ACCESS_TOKEN   provide access token
-    --afile=ART_FILE              provide artifact file, one artifact path per line
-    --rfile=REPO_FILE             provide repository file, one repository per line
+    --connect-timeout=SECONDS     seconds to wait for a connection to the server [default: 10]
+    --read-timeout=SECONDS        seconds to wait for the server to send data [default: 300]
+    --deadline=MINUTES            stop making requests MINUTES after the run starts, unprocessed artifacts are written to deadline_skipped_artifacts
+    --hedge                       resend slow trace, stats and listing requests once they pass the observed p95 latency
+    --snapshot-dir=DIR            keep repository listing snapshots in DIR and only re-list folders that changed
+    --refresh                     rebuild the snapshots from a full listing
+    --crawl                       list repositories folder by folder in parallel instead of one deep listing per repository
+    --crawl-per-repo=N            maximum concurrent folder listings per repository when crawling [default: 4]
+    --report                      write per repository and per folder result counts to rollup.json and rollup.txt
+    --report-depth=DEPTH          folder levels below each repository to count results at [default: 1]
+    --resolve-virtual             list virtual repositories through their member repositories so each artifact is traced once
+    --spill-dir=DIR               directory for the temporary table used to deduplicate artifacts [default: .]
+    --afile=ART_FILE              provide artifact file, one artifact path per line ('-' for stdin, may be gzipped)
+    --rfile=REPO_FILE             provide repository file, one repository per line ('-' for stdin, may be gzipped)
     --after=AFTER_DATE            operate only on artifacts last modified after AFTER_DATE (ignores afile artifacts) ex: 2023-01-01
-    DEL_FILE                      provide file of artifacts to delete, one artifact path per line
+    --sample=SAMPLE               trace only a random sample of SAMPLE artifacts per repository and estimate untraceable rates
+    --sample-rate=RATE            trace only a random fraction RATE (0-1) of the artifacts in each repository and estimate untraceable rates
+    --delete                      plan a delete run of the listed artifacts instead of a check run
+    --samples=SAMPLES             number of artifacts to probe at each concurrency level [default: 20]
+    --window=MINUTES              exit with status 2 if the projected run exceeds MINUTES
+    --peer=PEER                   base url of an instance to compare against --url, may be repeated
+    --trace-divergent             trace divergent artifacts on every instance where they diverge
+    DEL_FILE                      provide file of artifacts to delete, one artifact path per line ('-' for stdin, may be gzipped)
 """
 import requests
 import logging
+import random
 import threading
+import time
 from queue import Empty, Queue
 from docopt import docopt
 from urllib import parse
-from os.path import isfile
-from .helpers import get_config
+from os import makedirs
+from os.path import dirname, isfile, join
+from itertools import chain
+from collections import deque
+from .helpers import LatencyTracker, Rollup, get_config, iter_lines, read_snapshot, setup_logging, unique, wilson_interval, write_snapshot
 from datetime import datetime
 from sys import exit
 
@@ -36,6 +73,9 @@ ARTIFACT_UNKNOWN = 'trace_failure'
 ARTIFACT_DELETED = 'artifact_deleted'
 ARTIFACT_NOT_DELETED = 'artifact_not_deleted'
 ARTIFACT_IS_FOLDER = 'artifact_is_folder'
+ARTIFACT_MISSING = 'artifact_missing'
+ARTIFACT_EXTRA = 'artifact_extra'
+ARTIFACT_DIVERGENT = 'artifact_divergent'
 output = []
 after_date = ''
 
@@ -43,32 +83,167 @@ class jfIntegrity():
     """A class to provide Jfrog artifact integrity checking capabilities."""
 
 
-    def __init__(self, server, access_token, debug=False):
+    def __init__(self, server, access_token, debug=False, log_json=False, timeout=(10, 300), hedge=False, hedge_workers=64,
+                 snapshot_dir=None, refresh=False, crawl_threads=None, crawl_per_repo=4, report_depth=None,
+                 resolve_virtual=False, spill_dir='.'):
         """
         Initialize class.
 
         :param server: String name of artifactory server
         :param access_token: String access token with sufficient permissions to repositories and artifacts of interest
         :param debug: Boolean whether to enable debug logging
+        :param log_json: Boolean whether to write the log as JSON lines
+        :param timeout: Tuple of Float connect and read timeouts in seconds for each request
+        :param hedge: Boolean whether to send a duplicate of slow idempotent GETs once they pass the observed p95 latency
+        :param hedge_workers: Integer maximum hedgeable requests in flight, abandoned attempts included
+        :param snapshot_dir: String directory to keep repository listing snapshots in, None to always list in full
+        :param refresh: Boolean whether to rebuild snapshots from a full listing
+        :param crawl_threads: Integer number of threads to crawl repositories folder by folder with, None to deep list them
+        :param crawl_per_repo: Integer maximum concurrent folder listings per repository when crawling
+        :param report_depth: Integer folder depth to roll results up to per repository, None for no rollup report
+        :param resolve_virtual: Boolean whether to list virtual repositories through their physical member repositories
+        :param spill_dir: String directory for the on disk table used to deduplicate artifacts
         """
         self.server = server
         self.access_token = access_token
         self.headers = {'Authorization': f'Bearer {self.access_token}'}
+        self.timeout = timeout
+        self.deadline = None
+        self.hedge = hedge
+        self.hedge_slots = threading.Semaphore(hedge_workers)
+        self.latency = {}
+        self.received = {}
+        self.received_lock = threading.Lock()
+        self.snapshot_dir = snapshot_dir
+        self.refresh = refresh
+        self.crawl_threads = crawl_threads
+        self.crawl_per_repo = crawl_per_repo
+        self.rollup = Rollup(report_depth) if report_depth is not None else None
+        self.resolve_virtual = resolve_virtual
+        self.aliases = {}
+        self.spill_dir = spill_dir
 
-        self.logger = logging.getLogger('logger')
-        streamHandler = logging.StreamHandler()
-        fileHandler = logging.FileHandler('log', encoding='utf-8')
-        self.logger.addHandler(streamHandler)
-        self.logger.addHandler(fileHandler)
-        formatter = logging.Formatter('[%(asctime)s] [%(module)s.%(funcName)s] [%(levelname)s] %(message)s')
-        streamHandler.setFormatter(formatter)
-        fileHandler.setFormatter(formatter)
+        self.logger = setup_logging('logger', json_format=log_json)
 
         if debug:
             self.logger.setLevel(logging.DEBUG)
         else:
             self.logger.setLevel(logging.INFO)
 
+    def set_deadline(self, seconds):
+        """
+        Set an overall deadline for the run; requests started after it fail with a timeout.
+
+        :param seconds: Float seconds from now, None to clear the deadline
+        """
+        self.deadline = time.monotonic() + seconds if seconds is not None else None
+
+    def remaining(self):
+        """
+        Get the time left before the run deadline.
+
+        :returns: Float seconds, or None when no deadline is set
+        """
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    def request_timeout(self):
+        """
+        Get the connect and read timeouts for a request, shortened to fit the run deadline.
+
+        :returns: Tuple of Float connect and read timeouts in seconds
+        :raises requests.exceptions.Timeout: if the run deadline has passed
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return self.timeout
+        if remaining <= 0:
+            raise requests.exceptions.Timeout(f'run deadline exceeded for {self.server}')
+        return tuple(min(t, remaining) for t in self.timeout)
+
+    def timed_get(self, kind, url, params=None, timeout=None):
+        """
+        GET a url, recording its latency and the bytes received under kind.
+
+        :param kind: String name the latency and bytes are tracked under
+        :param url: String url
+        :param params: Dictionary of query parameters
+        :param timeout: Tuple of Float connect and read timeouts in seconds
+        :returns: requests.Response
+        """
+        start = time.monotonic()
+        r = requests.get(url, params=params, headers=self.headers, timeout=timeout)
+        self.latency.setdefault(kind, LatencyTracker()).add(time.monotonic() - start)
+        with self.received_lock:
+            self.received[kind] = self.received.get(kind, 0) + len(r.content)
+        return r
+
+    def http_get(self, kind, url, params=None):
+        """
+        GET an idempotent url with the request timeouts, hedging it when enabled.
+
+        A hedged request that has not completed by the p95 latency observed for
+        its kind is sent again with a shorter timeout, and whichever response
+        arrives first is used. Attempts run in their own threads, and at most
+        hedge_workers hedgeable requests, abandoned attempts included, are in flight
+        at once; beyond that requests are sent without hedging.
+
+        :param kind: String name the latency is tracked under
+        :param url: String url
+        :param params: Dictionary of query parameters
+        :returns: requests.Response
+        :raises requests.exceptions.RequestException: if every attempt failed
+        """
+        timeout = self.request_timeout()
+        delay = self.latency[kind].percentile(0.95) if self.hedge and kind in self.latency else None
+        if delay is None or not self.hedge_slots.acquire(blocking=False):
+            return self.timed_get(kind, url, params, timeout)
+
+        lock = threading.Lock()
+        done = threading.Event()
+        state = {'running': 1, 'response': None, 'errors': []}
+
+        def attempt(attempt_timeout):
+            r = None
+            error = None
+            try:
+                r = self.timed_get(kind, url, params, attempt_timeout)
+            except Exception as e:
+                error = e
+            with lock:
+                state['running'] -= 1
+                if r is not None and state['response'] is None:
+                    state['response'] = r
+                    done.set()
+                elif r is not None:
+                    r.close()
+                else:
+                    state['errors'].append(error)
+                if not state['running']:
+                    done.set()
+                    self.hedge_slots.release()
+
+        threading.Thread(target=attempt, args=(timeout,), daemon=True).start()
+        if not done.wait(delay):
+            try:
+                hedge_timeout = tuple(min(t, max(10 * delay, 1.0)) for t in self.request_timeout())
+            except requests.exceptions.Timeout:
+                # past the run deadline, leave the first attempt to finish alone
+                hedge_timeout = None
+            with lock:
+                hedge = hedge_timeout is not None and state['response'] is None and state['running'] > 0
+                if hedge:
+                    state['running'] += 1
+            if hedge:
+                self.logger.debug(f'hedging {kind} request for {url} after {delay:.3f}s')
+                threading.Thread(target=attempt, args=(hedge_timeout,), daemon=True).start()
+        done.wait()
+        with lock:
+            if state['response'] is not None:
+                return state['response']
+            raise state['errors'][-1]
+
     def test_connection(self):
         """
         Ensure Artifactory server responds without error.
@@ -78,10 +253,13 @@ class jfIntegrity():
         url = f'{self.server}'
         r = None
         try:
-            r = requests.get(url, headers=self.headers)
+            r = requests.get(url, headers=self.headers, timeout=self.timeout)
         except requests.exceptions.MissingSchema:
             self.logger.error(f'please specify http or https schema with {self.server}')
             return False
+        except requests.exceptions.Timeout:
+            self.logger.error(f'timeout connecting to {self.server}')
+            return False
         except requests.exceptions.ConnectionError:
             self.logger.error(f'error connecting to {self.server}')
             return False
@@ -111,7 +289,7 @@ class jfIntegrity():
         url = f'{self.server}/artifactory/api/storage/{safe_artifact}'
         r = None
         try:
-            r = requests.get(url, headers=self.headers)
+            r = self.http_get('stats', url)
         except requests.exceptions.Timeout:
             self.logger.error(f'timeout connecting to {self.server}')
         except requests.exceptions.RequestException as e:
@@ -139,7 +317,7 @@ class jfIntegrity():
         params = {'skipUpdateStats': 'true', 'trace': 'null'}
         r = None
         try:
-            r = requests.get(url, headers=self.headers, params=params)
+            r = self.http_get('trace', url, params)
         except requests.exceptions.Timeout:
             self.logger.error(f'timeout connecting to {self.server}')
         except requests.exceptions.RequestException as e:
@@ -152,7 +330,8 @@ class jfIntegrity():
             if 200 <= r.status_code < 300:
                 return r.text
         else:
-            self.logger.error(f'could not get trace for {artifact}, received {r.status_code}')
+            status = r.status_code if r is not None else 'no response'
+            self.logger.error(f'could not get trace for {artifact}, received {status}')
 
     def get_contents(self, repository):
         """
@@ -171,7 +350,7 @@ class jfIntegrity():
                   'mdTimestamps': '1',
                   'includeRootPath': '1'}
         try:
-            r = requests.get(url, params=params, headers=self.headers)
+            r = self.http_get('contents', url, params)
         except requests.exceptions.Timeout:
             self.logger.error(f'timeout connecting to {self.server}')
         except requests.exceptions.RequestException as e:
@@ -186,6 +365,118 @@ class jfIntegrity():
         else:
             self.logger.error(f'could not get contents for {repository}')
 
+    def get_children(self, path):
+        """
+        List the immediate children of a repository path, with their metadata.
+
+        :param path: String repository path to list children for
+        :returns: Dictionary of contents one level deep
+        :raises exception: if requests.exceptions.RequestException encountered, forwards it
+        """
+        safe_path = parse.quote(path)
+        url = f'{self.server}/artifactory/api/storage/{safe_path}'
+        r = None
+        params = {'list': 'null',
+                  'deep': '1',
+                  'depth': '1',
+                  'listFolders': '1',
+                  'mdTimestamps': '1'}
+        try:
+            r = self.http_get('children', url, params)
+        except requests.exceptions.Timeout:
+            self.logger.error(f'timeout connecting to {self.server}')
+        except requests.exceptions.RequestException as e:
+            self.logger.exception(f'unrecoverable exception {e} connecting to {self.server}')
+        finally:
+            if r:
+                r.close()
+
+        if r:
+            if 200 <= r.status_code < 300:
+                return r.json()
+        else:
+            self.logger.error(f'could not get children for {path}')
+
+    def get_last_modified(self, path):
+        """
+        Get the last modified time of the most recently modified item under a repository path.
+
+        :param path: String repository path
+        :returns: String lastModified in isoformat
+        :raises exception: if requests.exceptions.RequestException encountered, forwards it
+        """
+        safe_path = parse.quote(path)
+        url = f'{self.server}/artifactory/api/storage/{safe_path}'
+        r = None
+        try:
+            r = self.http_get('last_modified', url, {'lastModified': 'null'})
+        except requests.exceptions.Timeout:
+            self.logger.error(f'timeout connecting to {self.server}')
+        except requests.exceptions.RequestException as e:
+            self.logger.exception(f'unrecoverable exception {e} connecting to {self.server}')
+        finally:
+            if r:
+                r.close()
+
+        if r:
+            if 200 <= r.status_code < 300:
+                return r.json().get('lastModified')
+        else:
+            self.logger.error(f'could not get last modified for {path}')
+
+    def report_names(self, repo):
+        """
+        Get the repository names results for a repository are reported under.
+
+        :param repo: String name of the repository holding the artifact
+        :returns: List of Strings, repo itself followed by any requested virtual repositories that resolved to it
+        """
+        return [repo] + [name for name in self.aliases.get(repo, []) if name != repo]
+
+    def record(self, artifact, result):
+        """
+        Record the result for an artifact in global List 'output' and in the rollup report, if any.
+
+        The literal path is always recorded; artifacts of a repository resolved from virtual
+        repositories are also recorded under each requested virtual repository.
+
+        :param artifact: String name of the artifact with full path
+        :param result: String result of the artifact
+        """
+        global output
+        repo, sep, path = artifact.partition('/')
+        for name in self.report_names(repo):
+            output.append((f'{name}{sep}{path}', result))
+            if self.rollup:
+                self.rollup.add(f'{name}{sep}{path}', result)
+
+    def get_repository(self, repository):
+        """
+        Get the configuration of a repository.
+
+        :param repository: String repository to get the configuration of
+        :returns: Dictionary containing the configuration, including rclass and, for virtual repositories, repositories
+        :raises exception: if requests.exceptions.RequestException encountered, forwards it
+        """
+        safe_repository = parse.quote(repository)
+        url = f'{self.server}/artifactory/api/repositories/{safe_repository}'
+        r = None
+        try:
+            r = self.http_get('repositories', url)
+        except requests.exceptions.Timeout:
+            self.logger.error(f'timeout connecting to {self.server}')
+        except requests.exceptions.RequestException as e:
+            self.logger.exception(f'unrecoverable exception {e} connecting to {self.server}')
+        finally:
+            if r:
+                r.close()
+
+        if r:
+            if 200 <= r.status_code < 300:
+                return r.json()
+        else:
+            self.logger.error(f'could not get configuration for {repository}')
+
     def del_artifact(self, artifact):
         """
         Remove an artifact unless that artifact is a folder; puts result in global List 'output.'
@@ -194,16 +485,20 @@ class jfIntegrity():
         :raises exception: if requests.exceptions.RequestException encountered, forwards it
         """
         self.logger.debug(f'start remove artifact {artifact}')
-        global output
-        safe_artifact = parse.quote(artifact)
-        if self.is_folder(safe_artifact):
-            output.append((artifact, ARTIFACT_IS_FOLDER))
+        folder = self.is_folder(artifact)
+        if folder is None:
+            self.record(artifact, ARTIFACT_NOT_DELETED)
+            self.logger.error(f'could not tell if {artifact} is a folder, it will not be deleted')
+            return
+        if folder:
+            self.record(artifact, ARTIFACT_IS_FOLDER)
             self.logger.info(f'folder {artifact} will not be deleted')
             return
+        safe_artifact = parse.quote(artifact)
         url = f'{self.server}/artifactory/{safe_artifact}'
         r = None
         try:
-            r = requests.delete(url, headers=self.headers)
+            r = requests.delete(url, headers=self.headers, timeout=self.request_timeout())
         except requests.exceptions.Timeout:
             self.logger.error(f'timeout connecting to {self.server}')
         except requests.exceptions.RequestException as e:
@@ -213,13 +508,13 @@ class jfIntegrity():
                 r.close()
         if r:
             if 200 <= r.status_code < 300:
-                output.append((artifact, ARTIFACT_DELETED))
+                self.record(artifact, ARTIFACT_DELETED)
                 self.logger.info(f'deleted: {artifact}')
             else:
-                output.append((artifact, ARTIFACT_NOT_DELETED))
+                self.record(artifact, ARTIFACT_NOT_DELETED)
                 self.logger.error(f'could not delete artifact for {artifact}, received {r.status_code}')
         else:
-            output.append((artifact, ARTIFACT_NOT_DELETED))
+            self.record(artifact, ARTIFACT_NOT_DELETED)
             self.logger.error(f'unrecoverable error for artifact {artifact}')
 
     def qdel_artifact(self, q, thread_no):
@@ -245,20 +540,28 @@ class jfIntegrity():
 
         :param artifact: String name of artifact with full path to trace
         """
+        self.record(artifact, self.trace_verdict(artifact))
+
+    def trace_verdict(self, artifact):
+        """
+        Trace an artifact and classify the result.
+
+        :param artifact: String name of artifact with full path to trace
+        :returns: String one of ARTIFACT_GOOD, ARTIFACT_BAD or ARTIFACT_UNKNOWN
+        """
         self.logger.debug(f'started remove artifact {artifact}')
-        global output
         safe_artifact = parse.quote(artifact)
         trace = self.get_trace(safe_artifact)
         if trace:
             if trace.find(TRACE_SUCCESS) == -1:
-                output.append((artifact, ARTIFACT_BAD))
                 self.logger.info(f'{artifact}: {ARTIFACT_BAD}')
+                return ARTIFACT_BAD
             else:
-                output.append((artifact, ARTIFACT_GOOD))
                 self.logger.debug(f'{artifact}: {ARTIFACT_GOOD}')
+                return ARTIFACT_GOOD
         else:
-            output.append((artifact, ARTIFACT_UNKNOWN))
             self.logger.error(f'{artifact}: {ARTIFACT_UNKNOWN}')
+            return ARTIFACT_UNKNOWN
 
     def qtrace(self, q, thread_no):
         """
@@ -283,7 +586,7 @@ class jfIntegrity():
         Indicate if item is a folder (contains child key).
 
         :param item: String full path of item
-        :returns: Boolean indicating if the item is a folder
+        :returns: Boolean indicating if the item is a folder, None if its stats could not be read
         """
         stats = self.get_stats(item)
         if stats:
@@ -293,6 +596,9 @@ class jfIntegrity():
             elif 'errors' in stats.keys():
                 self.logger.error(f'errors detecting if {item} is a folder')
                 return True
+        else:
+            self.logger.error(f'no stats detecting if {item} is a folder')
+            return None
         self.logger.debug(f'detected non folder: {item}')
         return False
 
@@ -312,20 +618,15 @@ class jfIntegrity():
         """
         Get items from a file, assumes they are one item per line.
 
-        :param file: Path to the file
-        :returns: List containing the items
+        :param file: Path to the file, '-' for stdin; gzip compressed files are accepted
+        :returns: Iterator yielding the items lazily
         :raises: any exception that file like objects can throw would be raised here
         """
-        content = ''
-        if not isfile(file):
+        if file != '-' and not isfile(file):
             self.logger.error(f'non file or cannot read {file}')
             exit(1)
 
-        with open(file, 'r') as f:
-            content = f.read()
-
-        if content:
-            return content.strip().split('\n')
+        return iter_lines(file)
 
     def cat_artifacts(self, repos, after):
         """
@@ -333,21 +634,266 @@ class jfIntegrity():
 
         :param repos: List of Strings name of repos to list artifacts from
         :param after: String in format of YYYY-MM-DD if provided only artifacts younger will be included
-        :returns: List of artifacts from the repositories
+        :returns: List of artifacts from the repositories, or a Generator streaming them in crawl mode
         """
+        if self.crawl_threads:
+            return self.crawl(repos, after)
+
         artifacts = []
-        rarts = []
 
         for repo in repos:
-            ret = self.get_contents(repo)
-            if ret:
+            rarts = []
+            files = self.repo_files(repo)
+            if files:
                 if after:
-                    rarts = [ f'{repo}{art["uri"]}' for art in ret['files'] if not art['folder'] and self.is_later(art['lastModified'], after) ]
+                    rarts = [ f'{repo}{art["uri"]}' for art in files if not art['folder'] and self.is_later(art['lastModified'], after) ]
                 else:
-                    rarts = [ f'{repo}{art["uri"]}' for art in ret['files'] if not art['folder'] ]
+                    rarts = [ f'{repo}{art["uri"]}' for art in files if not art['folder'] ]
             artifacts = artifacts + rarts
         return artifacts
 
+    def crawl(self, repos, after=None):
+        """
+        Walk the folder trees of repos breadth first with one level listings, yielding artifacts as they are found.
+
+        Folders wait in a queue per repository. Each of crawl_threads threads takes the
+        next folder of a repository with fewer than crawl_per_repo listings in flight,
+        so one large repository cannot park every thread while others wait.
+
+        :param repos: List of Strings name of repos to list artifacts from
+        :param after: String in format of YYYY-MM-DD if provided only artifacts younger will be included
+        :returns: Generator of Strings artifact with full path
+        """
+        if not repos:
+            return
+        folders = {repo: deque(['']) for repo in repos}
+        in_flight = {repo: 0 for repo in repos}
+        state = {'pending': len(folders), 'stopped': False}
+        cond = threading.Condition()
+        found = Queue(maxsize=10000)
+        done = object()
+
+        def next_folder():
+            with cond:
+                while True:
+                    if state['stopped'] or not state['pending']:
+                        return None, None
+                    for repo, queue in folders.items():
+                        if queue and in_flight[repo] < self.crawl_per_repo:
+                            in_flight[repo] += 1
+                            return repo, queue.popleft()
+                    cond.wait()
+
+        def worker():
+            while True:
+                repo, path = next_folder()
+                if repo is None:
+                    return
+                subfolders = []
+                try:
+                    ret = self.get_children(f'{repo}{path}')
+                    if ret:
+                        for child in ret['files']:
+                            uri = child['uri']
+                            if not uri.strip('/'):
+                                continue
+                            if child['folder']:
+                                subfolders.append(f'{path}{uri}')
+                            elif not after or self.is_later(child['lastModified'], after):
+                                found.put(f'{repo}{path}{uri}')
+                    else:
+                        self.logger.error(f'could not crawl {repo}{path}, its artifacts are not included')
+                except Exception as e:
+                    self.logger.exception(f'unrecoverable exception {e} crawling {repo}{path}')
+                finally:
+                    with cond:
+                        folders[repo].extend(subfolders)
+                        in_flight[repo] -= 1
+                        state['pending'] += len(subfolders) - 1
+                        if not state['pending']:
+                            found.put(done)
+                        cond.notify_all()
+
+        for i in range(self.crawl_threads):
+            threading.Thread(target=worker, daemon=True).start()
+        try:
+            while True:
+                artifact = found.get()
+                if artifact is done:
+                    return
+                yield artifact
+        finally:
+            with cond:
+                state['stopped'] = True
+                cond.notify_all()
+
+    def repo_files(self, repo):
+        """
+        List the files of a repository, from its snapshot when snapshots are enabled.
+
+        :param repo: String name of the repository
+        :returns: Iterable of Dictionaries with uri, lastModified, size, sha2 and folder keys, None if it could not be listed
+        """
+        if self.snapshot_dir:
+            return self.snapshot_files(repo)
+        ret = self.get_contents(repo)
+        if ret:
+            return ret['files']
+
+    def snapshot_path(self, repo):
+        """
+        Get the snapshot file of a repository, kept in a subdirectory per server.
+
+        :param repo: String name of the repository
+        :returns: String path of the snapshot file
+        """
+        url = parse.urlsplit(self.server)
+        server = parse.quote(f'{url.netloc}{url.path}'.rstrip('/') or self.server, safe='')
+        return join(self.snapshot_dir, server, f'{parse.quote(repo, safe="")}.tsv.gz')
+
+    def snapshot_files(self, repo):
+        """
+        Refresh the snapshot of a repository and list its files from it.
+
+        :param repo: String name of the repository
+        :returns: Generator of Dictionaries with uri, lastModified, size, sha2 and folder keys, None if there is no snapshot
+        """
+        path = self.snapshot_path(repo)
+        self.refresh_snapshot(repo)
+        if not isfile(path):
+            return None
+        meta, records = read_snapshot(path)
+        return ({'uri': uri, 'lastModified': last_modified, 'size': size, 'sha2': sha2, 'folder': False}
+                for uri, last_modified, size, sha2 in records)
+
+    def list_records(self, path, prefix=''):
+        """
+        Deep list a repository path as snapshot records.
+
+        :param path: String repository path to list
+        :param prefix: String uri prefix of path within its repository
+        :returns: List of Tuples (uri, lastModified, size, sha256), None if it could not be listed
+        """
+        ret = self.get_contents(path)
+        if not ret:
+            return None
+        return [(f'{prefix}{art["uri"]}', art['lastModified'], art.get('size'), art.get('sha2'))
+                for art in ret['files'] if not art['folder']]
+
+    def refresh_snapshot(self, repo):
+        """
+        Bring the snapshot of a repository up to date, re-listing only what changed.
+
+        A repository whose most recently modified item is unchanged is not listed at
+        all. Otherwise its top level is listed one level deep and only the top level
+        folders whose most recently modified item changed are deep listed again. The
+        top level folders are checked by crawl_per_repo threads at once.
+        Deletions inside an unchanged folder are not detected; refresh forces a full listing.
+
+        :param repo: String name of the repository
+        """
+        path = self.snapshot_path(repo)
+        makedirs(dirname(path), exist_ok=True)
+        latest = self.get_last_modified(repo)
+        if self.refresh or not isfile(path):
+            old = None
+        else:
+            old, old_records = read_snapshot(path)
+            if latest and old['lastModified'] == latest:
+                self.logger.debug(f'snapshot of {repo} is current')
+                return
+
+        children = self.get_children(repo)
+        if not children:
+            return
+        top_files = [(child['uri'], child['lastModified'], child.get('size'), child.get('sha2'))
+                     for child in children['files'] if not child['folder']]
+        names = [child['uri'].strip('/') for child in children['files'] if child['folder'] and child['uri'].strip('/')]
+        folders = dict.fromkeys(names)
+        q = Queue()
+        for name in names:
+            q.put(name)
+
+        def worker():
+            while True:
+                try:
+                    name = q.get_nowait()
+                except Empty:
+                    return
+                folders[name] = self.get_last_modified(f'{repo}/{name}')
+
+        workers = [threading.Thread(target=worker, daemon=True) for i in range(min(self.crawl_per_repo, len(names)))]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+        if old is None:
+            records = self.list_records(repo)
+            if records is None:
+                return
+            self.logger.info(f'snapshot of {repo} fully listed')
+            write_snapshot(path, {'repo': repo, 'lastModified': latest, 'folders': folders}, records)
+            return
+
+        changed = {name for name, last_modified in folders.items()
+                   if not last_modified or old['folders'].get(name) != last_modified}
+        fresh = []
+        kept = []
+        for name in changed:
+            records = self.list_records(f'{repo}/{name}', f'/{name}')
+            if records is None:
+                # keep the old records and lastModified so the folder is listed again next time
+                kept.append(name)
+                folders[name] = old['folders'].get(name)
+                continue
+            fresh += records
+        self.logger.info(f'snapshot of {repo} refreshed, re-listed {len(changed) - len(kept)} of {len(folders)} folders')
+
+        def merged():
+            for record in old_records:
+                name = record[0].split('/')[1] if record[0].count('/') > 1 else None
+                if name in folders and (name not in changed or name in kept):
+                    yield record
+            yield from top_files
+            yield from fresh
+
+        write_snapshot(path, {'repo': repo, 'lastModified': latest if not kept else old['lastModified'], 'folders': folders}, merged())
+
+
+    def resolve_repos(self, repos):
+        """
+        Resolve virtual repositories to the physical repositories that hold their artifacts.
+
+        Each physical repository is returned once, and the requested names it was
+        reached through are kept in 'aliases' so results can be reported under them.
+
+        :param repos: List of Strings name of requested repos
+        :returns: List of Strings name of physical repos to list artifacts from
+        """
+        physical = []
+
+        def resolve(repo, requested, seen):
+            if repo in seen:
+                return
+            seen.add(repo)
+            config = self.get_repository(repo)
+            if config and config.get('rclass') == 'virtual':
+                self.logger.debug(f'virtual repository {repo} has members {config.get("repositories", [])}')
+                for member in config.get('repositories', []):
+                    resolve(member, requested, seen)
+                return
+            if repo not in self.aliases:
+                self.aliases[repo] = []
+                physical.append(repo)
+            if requested not in self.aliases[repo]:
+                self.aliases[repo].append(requested)
+
+        for repo in repos:
+            resolve(repo, repo, set())
+        self.logger.info(f'resolved repositories {repos} to {physical}')
+        return physical
+
     def compile_artifacts(self, repos=None, afile=None, rfile=None, after=None):
         """
         List artifacts from various sources.
@@ -356,13 +902,24 @@ class jfIntegrity():
         :param afile: String name of file containing artifacts to include in output, one per line
         :param rfile: String name of file containing repos to list artifacts from, one per line
         :param after: String date in format YYYY-MM-DD if provided only artifacts younger will be included
-        :returns: List of artifacts from the various sources, deduplicated
+        :returns: Iterator of artifacts from the various sources, deduplicated; with resolve_virtual, repos and
+                  rfile repos are resolved together so each physical artifact is listed once
         """
         arts = []
         afile_arts = []
         rfile_arts = []
 
         self.logger.debug(f'compiling list of artifacts from repos {repos}, afile {afile}, and rfile {rfile}')
+        if self.resolve_virtual:
+            requested = list(repos or [])
+            if rfile:
+                requested += list(self.read_items(rfile))
+            if requested:
+                arts = self.cat_artifacts(self.resolve_repos(requested), after)
+            if afile:
+                afile_arts = self.read_items(afile)
+            return unique(chain(arts, afile_arts), self.spill_dir)
+
         if repos:
             arts = self.cat_artifacts(repos, after)
 
@@ -370,11 +927,277 @@ class jfIntegrity():
             afile_arts = self.read_items(afile)
 
         if rfile:
-            rfile_repos = self.read_items(rfile)
+            rfile_repos = list(self.read_items(rfile))
             if rfile_repos:
                 rfile_arts = self.cat_artifacts(rfile_repos, after)
 
-        return list(set(arts + afile_arts + rfile_arts))
+        return unique(chain(arts, afile_arts, rfile_arts), self.spill_dir)
+
+    def stratified_sample(self, artifacts, n=None, rate=None, per_repo=True):
+        """
+        Count artifacts per repository and draw a random sample per repository in one pass.
+
+        With n, each repository gets a uniform sample of up to n artifacts; with rate,
+        each artifact is included independently with probability rate. Without per_repo
+        all artifacts form a single stratum, sampled under the key None.
+
+        :param artifacts: Iterable of Strings artifact with full path
+        :param n: Integer sample size per repository
+        :param rate: Float fraction of each repository to sample
+        :param per_repo: Boolean whether each repository is sampled separately
+        :returns: Tuple of Dictionary artifact counts keyed by repository and Dictionary of sample Lists keyed by repository
+        """
+        counts = {}
+        seen = {}
+        samples = {}
+        for artifact in artifacts:
+            repo = artifact.split('/', 1)[0]
+            counts[repo] = counts.get(repo, 0) + 1
+            stratum = repo if per_repo else None
+            k = seen.get(stratum, 0)
+            seen[stratum] = k + 1
+            sample = samples.setdefault(stratum, [])
+            if rate is not None:
+                if random.random() < rate:
+                    sample.append(artifact)
+            elif k < n:
+                sample.append(artifact)
+            else:
+                i = random.randint(0, k)
+                if i < n:
+                    sample[i] = artifact
+        return counts, samples
+
+    def estimate(self, counts, results, z=1.96):
+        """
+        Estimate the untraceable rate of each repository from traced samples.
+
+        Trace failures carry no verdict and are left out of the rate.
+
+        :param counts: Dictionary artifact counts keyed by repository, counted under requested names when resolved from virtual repositories
+        :param results: List of Tuples (artifact, result) as collected in 'output'
+        :param z: Float standard normal quantile of the confidence interval
+        :returns: Dictionary keyed by repository of Dictionaries with the estimate
+        """
+        totals = {}
+        for repo, count in counts.items():
+            for name in self.report_names(repo):
+                totals[name] = totals.get(name, 0) + count
+        estimates = {repo: {'artifacts': count, 'sampled': 0, 'untraceable': 0, 'failures': 0, 'bad': []}
+                     for repo, count in totals.items()}
+        for artifact, result in results:
+            est = estimates[artifact.split('/', 1)[0]]
+            if result == ARTIFACT_UNKNOWN:
+                est['failures'] += 1
+                continue
+            est['sampled'] += 1
+            if result == ARTIFACT_BAD:
+                est['untraceable'] += 1
+                est['bad'].append(artifact)
+        for est in estimates.values():
+            est['rate'] = est['untraceable'] / est['sampled'] if est['sampled'] else None
+            est['low'], est['high'] = wilson_interval(est['untraceable'], est['sampled'], z, est['artifacts'])
+        return estimates
+
+    def probe(self, sample, concurrency, delete=False):
+        """
+        Time the requests a run would make for a sample of artifacts at a given concurrency.
+
+        Check runs are probed with get_trace. Deletes are never issued; delete runs are
+        probed with the is_folder stats call instead.
+
+        :param sample: List of Strings artifact with full path
+        :param concurrency: Integer number of threads to probe with
+        :param delete: Boolean whether to probe for a delete run
+        :returns: Tuple of Float elapsed seconds, List of Float request latencies, Integer error count,
+                  Integer bytes received
+        """
+        kind = 'stats' if delete else 'trace'
+        received = self.received.get(kind, 0)
+        q = Queue()
+        for artifact in sample:
+            q.put(artifact)
+        latencies = []
+        errors = []
+
+        def worker():
+            while True:
+                try:
+                    artifact = q.get_nowait()
+                except Empty:
+                    return
+                start = time.monotonic()
+                if delete:
+                    ret = self.get_stats(artifact)
+                else:
+                    ret = self.get_trace(artifact)
+                latencies.append(time.monotonic() - start)
+                if not ret:
+                    errors.append(artifact)
+
+        start = time.monotonic()
+        workers = [threading.Thread(target=worker, daemon=True) for i in range(concurrency)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        return time.monotonic() - start, latencies, len(errors), self.received.get(kind, 0) - received
+
+    def plan(self, artifacts, threads, samples=20, delete=False):
+        """
+        Estimate the cost of a check or delete run without performing it.
+
+        Each of the doubling concurrency levels up to threads is probed with its own
+        random sample, so no level is timed against responses an earlier level has
+        already warmed up; when there are too few artifacts for that, the whole sample
+        is probed once to warm up and then reused at every level. The best concurrency
+        is the lowest level reaching 90% of the highest observed throughput.
+
+        :param artifacts: Iterable of Strings artifact with full path, as compile_artifacts returns
+        :param threads: Integer concurrency the run would use
+        :param samples: Integer number of artifacts to probe at each concurrency level
+        :param delete: Boolean whether to plan a delete run
+        :returns: Dictionary containing the plan
+        """
+        levels = []
+        level = 1
+        while level < threads:
+            levels.append(level)
+            level *= 2
+        levels.append(threads)
+
+        counts, sample = self.stratified_sample(artifacts, n=samples * len(levels), per_repo=False)
+        sample = sample.get(None, [])
+        total = sum(counts.values())
+        per_artifact = 2 if delete else 1
+
+        if len(sample) == samples * len(levels):
+            level_samples = [sample[i * samples:(i + 1) * samples] for i in range(len(levels))]
+        else:
+            sample = sample[:samples]
+            if sample:
+                self.probe(sample, 1, delete)
+            level_samples = [sample] * len(levels)
+
+        throughput = {}
+        latencies = []
+        errors = 0
+        received = 0
+        for level, chunk in zip(levels, level_samples):
+            if not chunk:
+                break
+            elapsed, lats, errs, size = self.probe(chunk, level, delete)
+            latencies += lats
+            errors += errs
+            received += size
+            # an artifact costs two requests in delete mode; only the stats call is probed
+            throughput[level] = len(chunk) / (elapsed * per_artifact) if elapsed else float('inf')
+            self.logger.debug(f'probe at concurrency {level}: {throughput[level]:.2f} artifacts/s')
+
+        best = threads
+        if throughput:
+            peak = max(throughput.values())
+            best = min(level for level, rate in throughput.items() if rate >= 0.9 * peak)
+
+        def projected(level):
+            if level not in throughput or not throughput[level]:
+                return None
+            return total / throughput[level]
+
+        latencies.sort()
+        return {'repos': counts,
+                'artifacts': total,
+                'requests': total * per_artifact,
+                'sampled_requests': len(latencies),
+                'latency_p50': latencies[len(latencies) // 2] if latencies else None,
+                'latency_p95': latencies[int(len(latencies) * 0.95)] if latencies else None,
+                'error_rate': errors / len(latencies) if latencies else None,
+                'bytes_per_artifact': received / len(latencies) if latencies else None,
+                'projected_bytes': total * received / len(latencies) if latencies else None,
+                'throughput': throughput,
+                'threads': threads,
+                'projected_seconds': projected(threads),
+                'best_threads': best,
+                'best_projected_seconds': projected(best)}
+
+    def listing(self, repo, after=None):
+        """
+        List the files of a repository as comparable records sorted by path.
+
+        :param repo: String name of the repository
+        :param after: String in format of YYYY-MM-DD if provided only artifacts younger will be included
+        :returns: List of Tuples (path, sha256, size, lastModified), None if the repository could not be listed
+        """
+        files = self.repo_files(repo)
+        if files is None:
+            return None
+        records = [(f'{repo}{art["uri"]}', art.get('sha2'), art.get('size'), art.get('lastModified'))
+                   for art in files if not art['folder'] and (not after or self.is_later(art['lastModified'], after))]
+        records.sort()
+        return records
+
+    def diff_listings(self, primary, other):
+        """
+        Merge two path sorted listings and report where they differ.
+
+        :param primary: Iterable of sorted Tuples (path, sha256, size, lastModified) from the reference instance
+        :param other: Iterable of sorted Tuples (path, sha256, size, lastModified) from the compared instance
+        :returns: Generator of Tuples (path, result) with result one of ARTIFACT_MISSING, ARTIFACT_EXTRA or ARTIFACT_DIVERGENT
+        """
+        primary = iter(primary)
+        other = iter(other)
+        p = next(primary, None)
+        o = next(other, None)
+        while p is not None or o is not None:
+            if o is None or (p is not None and p[0] < o[0]):
+                yield p[0], ARTIFACT_MISSING
+                p = next(primary, None)
+            elif p is None or o[0] < p[0]:
+                yield o[0], ARTIFACT_EXTRA
+                o = next(other, None)
+            else:
+                if p[1:] != o[1:]:
+                    yield p[0], ARTIFACT_DIVERGENT
+                p = next(primary, None)
+                o = next(other, None)
+
+    def compare(self, peers, repos, after=None):
+        """
+        Compare repositories on this instance against the same repositories on peer instances.
+
+        Each repository is listed on all instances concurrently, and only one
+        repository's listings are held at a time. A repository that cannot be listed
+        on an instance is logged and skipped for that instance rather than diffed as empty.
+
+        :param peers: List of jfIntegrity instances to compare against
+        :param repos: Iterable of Strings name of repos to compare
+        :param after: String in format of YYYY-MM-DD if provided only artifacts younger will be included
+        :returns: Generator of Tuples (peer, path, result)
+        """
+        instances = [self] + list(peers)
+        for repo in repos:
+            listings = [None] * len(instances)
+
+            def fetch(i):
+                listings[i] = instances[i].listing(repo, after)
+
+            workers = [threading.Thread(target=fetch, args=(i,), daemon=True) for i in range(len(instances))]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            self.logger.debug(f'listed {repo} on {len(instances)} instances')
+
+            if listings[0] is None:
+                self.logger.error(f'could not list {repo} on {self.server}, not compared')
+                continue
+            for peer, listing in zip(peers, listings[1:]):
+                if listing is None:
+                    self.logger.error(f'could not list {repo} on {peer.server}, not compared')
+                    continue
+                for path, result in self.diff_listings(listings[0], listing):
+                    self.logger.info(f'{peer.server} {path}: {result}')
+                    yield peer, path, result
 
 if __name__ == '__main__':
     arguments = docopt(__doc__, version='jfintegrity 1.0')
@@ -387,14 +1210,84 @@ if __name__ == '__main__':
     if not BASE_URL:
         BASE_URL = get_config('.url')
 
-    jfi = jfIntegrity(server=BASE_URL, access_token=ACCESS_TOKEN, debug=arguments['-V'])
+    options = {'debug': arguments['-V'],
+               'log_json': arguments['--log-json'],
+               'timeout': (float(arguments['--connect-timeout']), float(arguments['--read-timeout'])),
+               'hedge': arguments['--hedge'],
+               'hedge_workers': 2 * int(arguments['--threads']),
+               'snapshot_dir': arguments['--snapshot-dir'],
+               'refresh': arguments['--refresh'],
+               'crawl_threads': int(arguments['--threads']) if arguments['--crawl'] else None,
+               'crawl_per_repo': int(arguments['--crawl-per-repo']),
+               'report_depth': int(arguments['--report-depth']) if arguments['--report'] else None,
+               'resolve_virtual': arguments['--resolve-virtual'],
+               'spill_dir': arguments['--spill-dir']}
+    jfi = jfIntegrity(server=BASE_URL, access_token=ACCESS_TOKEN, **options)
     if not jfi.test_connection():
         print(f'could not connect to artifactory server...please check url')
         exit(1)
 
-    q = Queue()
+    if arguments['--deadline']:
+        jfi.set_deadline(float(arguments['--deadline']) * 60)
+
+    if arguments['compare']:
+        peers = [jfIntegrity(server=url, access_token=ACCESS_TOKEN, **options) for url in arguments['--peer']]
+        for peer in peers:
+            peer.deadline = jfi.deadline
+            if not peer.test_connection():
+                print(f'could not connect to artifactory server {peer.server}...please check url')
+                exit(1)
+        repos = list(arguments['REPO'])
+        if arguments['--rfile']:
+            repos += list(jfi.read_items(arguments['--rfile']))
+
+        files = {result: open(f'{result.split("_", 1)[1]}_artifacts', 'w')
+                 for result in (ARTIFACT_MISSING, ARTIFACT_EXTRA, ARTIFACT_DIVERGENT)}
+        divergent = []
+        try:
+            for peer, path, result in jfi.compare(peers, repos, after=arguments['--after']):
+                files[result].write(f'{peer.server} {path}\n')
+                if result == ARTIFACT_DIVERGENT and arguments['--trace-divergent']:
+                    divergent.append((peer, path))
+        finally:
+            for f in files.values():
+                f.close()
+
+        if divergent:
+            with open('divergent_traces', 'w') as f:
+                for peer, path in divergent:
+                    for instance in (jfi, peer):
+                        f.write(f'{instance.server} {path} {instance.trace_verdict(path)}\n')
+        exit(0)
+
+    if arguments['plan']:
+        threads = int(arguments['--threads'])
+        artifacts = jfi.compile_artifacts(repos=arguments['REPO'],
+                                          afile=arguments['--afile'],
+                                          rfile=arguments['--rfile'],
+                                          after=arguments['--after'])
+        plan = jfi.plan(artifacts, threads, samples=int(arguments['--samples']), delete=arguments['--delete'])
+
+        for repo, count in sorted(plan['repos'].items()):
+            print(f'{repo}: {count} artifacts')
+        print(f'artifacts: {plan["artifacts"]}')
+        print(f'requests: {plan["requests"]}')
+        if plan['sampled_requests']:
+            print(f'sampled latency p50/p95: {plan["latency_p50"]:.3f}s/{plan["latency_p95"]:.3f}s')
+            print(f'sampled error rate: {plan["error_rate"]:.2%}')
+            print(f'projected download: {plan["projected_bytes"] / 2 ** 20:.1f} MiB '
+                  f'({plan["bytes_per_artifact"]:.0f} bytes per artifact)')
+        if plan['projected_seconds'] is not None:
+            print(f'projected run time at {threads} threads: {plan["projected_seconds"] / 60:.1f} minutes')
+            print(f'best threads: {plan["best_threads"]} ({plan["best_projected_seconds"] / 60:.1f} minutes)')
+            if arguments['--window'] and plan['projected_seconds'] > float(arguments['--window']) * 60:
+                print(f'projected run exceeds window of {arguments["--window"]} minutes')
+                exit(2)
+        exit(0)
+
+    q = Queue(maxsize=int(arguments['--threads']) * 100)
     if arguments['delete']:
-        artifacts = jfi.read_items(arguments['DEL_FILE'])
+        artifacts = unique(jfi.read_items(arguments['DEL_FILE']), jfi.spill_dir)
         for i in range(int(arguments['--threads'])):
             worker = threading.Thread(target=jfi.qdel_artifact, args=(q, i,), daemon=True)
             worker.start()
@@ -404,14 +1297,28 @@ if __name__ == '__main__':
                                           afile=arguments['--afile'],
                                           rfile=arguments['--rfile'],
                                           after = after_date)
+        if arguments['--sample'] or arguments['--sample-rate']:
+            n = int(arguments['--sample']) if arguments['--sample'] else None
+            rate = float(arguments['--sample-rate']) if arguments['--sample-rate'] else None
+            sample_counts, samples = jfi.stratified_sample(artifacts, n=n, rate=rate)
+            artifacts = [art for sample in samples.values() for art in sample]
 
         for i in range(int(arguments['--threads'])):
             worker = threading.Thread(target=jfi.qtrace, args=(q, i,), daemon=True)
             worker.start()
 
-    for artifact in artifacts:
-        q.put(artifact)
+    skipped = 0
+    with open('deadline_skipped_artifacts', 'w') as f:
+        for artifact in artifacts:
+            if jfi.deadline is not None and jfi.remaining() <= 0:
+                jfi.record(artifact, ARTIFACT_NOT_DELETED if arguments['delete'] else ARTIFACT_UNKNOWN)
+                f.write(f'{artifact}\n')
+                skipped += 1
+                continue
+            q.put(artifact)
     q.join()
+    if skipped:
+        jfi.logger.error(f'run deadline reached, {skipped} artifacts were not processed, see deadline_skipped_artifacts')
 
     with open('traceable_artifacts', 'w') as f:
         for art in output:
@@ -426,4 +1333,19 @@ if __name__ == '__main__':
     with open('trace_failure_artifacts', 'w') as f:
         for art in output:
             if art[1] == ARTIFACT_UNKNOWN:
-                f.write(f'{art[0]}\n')
\ No newline at end of file
+                f.write(f'{art[0]}\n')
+
+    if jfi.rollup:
+        jfi.rollup.write('rollup.json', 'rollup.txt')
+
+    if arguments['check'] and (arguments['--sample'] or arguments['--sample-rate']):
+        estimates = jfi.estimate(sample_counts, output)
+        with open('sample_estimates', 'w') as f:
+            for repo, est in sorted(estimates.items()):
+                rate = f'{est["rate"]:.2%}' if est['rate'] is not None else 'n/a'
+                line = (f'{repo}: {est["untraceable"]} of {est["sampled"]} sampled untraceable ({est["artifacts"]} total), '
+                        f'estimated rate {rate} (95% CI {est["low"]:.2%}-{est["high"]:.2%}), {est["failures"]} trace failures')
+                print(line)
+                f.write(f'{line}\n')
+                for artifact in est['bad']:
+                    f.write(f'  {artifact}\n')
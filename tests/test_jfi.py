@@ -1,9 +1,18 @@
 import unittest
 import responses
 import requests
+import sys
 import json
-from unittest.mock import Mock
-from jfintegrity import jfintegrity
+import threading
+import logging
+import io
+import os
+import gzip
+import tempfile
+import time
+from itertools import chain
+from unittest.mock import Mock, patch
+from jfintegrity import jfintegrity, helpers
 
 stats_body = '''
 {
@@ -326,6 +335,12 @@ class TestjfIntegrity(unittest.TestCase):
         ret = self.jfi.test_connection()
         assert ret == False
 
+    @responses.activate
+    def test_test_connection_timeout(self):
+        responses.add(responses.GET, 'https://myserver', body=requests.exceptions.ReadTimeout())
+        ret = self.jfi.test_connection()
+        assert ret == False
+
     @responses.activate
     def test_get_stats_ok(self):
         responses.add(responses.GET, 'https://myserver/artifactory/api/storage/myrepo/mysubdir/myartifact.zip', body=stats_body, status=200)
@@ -377,6 +392,15 @@ class TestjfIntegrity(unittest.TestCase):
         ret = self.jfi.del_artifact('myrepo/mysubdir')
         assert responses.assert_call_count('https://myserver/artifactory/myrepo/mysubdir', 0) is True
 
+    @responses.activate
+    def test_del_artifact_quotes_path_once(self):
+        jfintegrity.output = []
+        responses.add(responses.GET, 'https://myserver/artifactory/api/storage/myrepo/my%20dir/myartifact.zip',
+                      json={'path': '/my dir/myartifact.zip'}, status=200)
+        responses.add(responses.DELETE, 'https://myserver/artifactory/myrepo/my%20dir/myartifact.zip', status=204)
+        self.jfi.del_artifact('myrepo/my dir/myartifact.zip')
+        assert jfintegrity.output == [('myrepo/my dir/myartifact.zip', 'artifact_deleted')]
+
     def test_trace_ok(self):
         jfintegrity.output = []
         self.jfi.get_trace = Mock(return_value=trace_body)
@@ -406,7 +430,22 @@ class TestjfIntegrity(unittest.TestCase):
 
     def test_read_items_returns_correct_list(self):
         ret = self.jfi.read_items('tests/rfile')
-        assert ret == ['myrepo1', 'myrepo2', 'myrepo3']
+        assert list(ret) == ['myrepo1', 'myrepo2', 'myrepo3']
+
+    def test_read_items_gzip_returns_correct_list(self):
+        with tempfile.TemporaryDirectory() as d:
+            file = os.path.join(d, 'rfile.gz')
+            with gzip.open(file, 'wt') as f:
+                f.write('myrepo1\n\nmyrepo2\nmyrepo3\n')
+            ret = self.jfi.read_items(file)
+            assert list(ret) == ['myrepo1', 'myrepo2', 'myrepo3']
+
+    def test_read_items_stdin_returns_correct_list(self):
+        stdin = Mock()
+        stdin.buffer = io.BytesIO(b'myrepo1\nmyrepo2\nmyrepo3\n')
+        with patch('jfintegrity.helpers.stdin', stdin):
+            ret = self.jfi.read_items('-')
+            assert list(ret) == ['myrepo1', 'myrepo2', 'myrepo3']
 
     def test_read_items_nofile_exits_with_error(self):
         with self.assertRaises(SystemExit):
@@ -456,4 +495,528 @@ class TestjfIntegrity(unittest.TestCase):
         ret = self.jfi.compile_artifacts(repos=['myrepo1'], afile='afile', rfile='rfile')
         expected = ['myrepo2/mysubdir/art5.zip', 'myrepo2/mysubdir/art4.zip', 'myrepo1/mysubdir/art2.zip',
                     'myrepo2/mysubdir/art1.zip', 'myrepo1/mysubdir/art1.zip', 'myrepo1/mysubdir/art3.zip']
-        self.assertEqual(ret.sort(), expected.sort())
+        self.assertEqual(sorted(ret), sorted(expected))
+
+    def test_unique_preserves_order_and_drops_repeats(self):
+        items = ['a', 'b', 'a', 'c', 'b', 'd']
+        with tempfile.TemporaryDirectory() as d:
+            ret = helpers.unique(items, d)
+            assert list(ret) == ['a', 'b', 'c', 'd']
+
+    def test_unique_is_exact_across_batches(self):
+        items = [f'art{i}' for i in range(2000)] * 2
+        with tempfile.TemporaryDirectory() as d:
+            ret = helpers.unique(items, d, batch=7)
+            assert list(ret) == [f'art{i}' for i in range(2000)]
+            assert os.listdir(d) == []
+
+    def test_stratified_sample_single_stratum_counts_per_repo(self):
+        artifacts = ['myrepo1/mysubdir/art1.zip', 'myrepo1/mysubdir/art2.zip', 'myrepo2/mysubdir/art1.zip']
+        counts, samples = self.jfi.stratified_sample(artifacts, n=2, per_repo=False)
+        assert counts == {'myrepo1': 2, 'myrepo2': 1}
+        assert list(samples) == [None]
+        assert len(samples[None]) == 2
+        assert set(samples[None]) <= set(artifacts)
+
+    def test_plan_check_counts_one_request_per_artifact(self):
+        self.jfi.get_trace = Mock(return_value=trace_body)
+        artifacts = [f'myrepo1/mysubdir/art{i}.zip' for i in range(10)]
+        ret = self.jfi.plan(iter(artifacts), 4, samples=5)
+        assert ret['artifacts'] == 10
+        assert ret['requests'] == 10
+        assert ret['error_rate'] == 0
+        assert set(ret['throughput'].keys()) == {1, 2, 4}
+        # too few artifacts for a sample per level, so the sample is warmed up first
+        assert self.jfi.get_trace.call_count == 20
+
+    def test_plan_probes_a_fresh_sample_at_each_level(self):
+        self.jfi.probe = Mock(side_effect=lambda sample, level, delete: (1.0, [0.1] * len(sample), 0, 0))
+        artifacts = [f'myrepo1/mysubdir/art{i}.zip' for i in range(30)]
+        self.jfi.plan(iter(artifacts), 4, samples=5)
+        probed = [c.args[0] for c in self.jfi.probe.call_args_list]
+        assert [len(sample) for sample in probed] == [5, 5, 5]
+        assert len(set(chain(*probed))) == 15
+
+    def test_plan_picks_lowest_threads_within_90_percent_of_peak(self):
+        elapsed = {1: 5.0, 2: 2.0, 4: 1.9}
+        self.jfi.probe = Mock(side_effect=lambda sample, level, delete: (elapsed[level], [0.1] * len(sample), 0, 0))
+        artifacts = [f'myrepo1/mysubdir/art{i}.zip' for i in range(30)]
+        ret = self.jfi.plan(iter(artifacts), 4, samples=5)
+        assert ret['throughput'] == {1: 1.0, 2: 2.5, 4: 5 / 1.9}
+        assert ret['best_threads'] == 2
+        assert round(ret['projected_seconds'], 6) == 11.4
+        assert round(ret['best_projected_seconds'], 6) == 12.0
+
+    def test_plan_projects_bytes_from_probed_responses(self):
+        self.jfi.probe = Mock(return_value=(1.0, [0.1] * 5, 0, 5000))
+        artifacts = [f'myrepo1/mysubdir/art{i}.zip' for i in range(10)]
+        ret = self.jfi.plan(iter(artifacts), 1, samples=5)
+        assert ret['bytes_per_artifact'] == 1000
+        assert ret['projected_bytes'] == 10000
+
+    @responses.activate
+    def test_probe_counts_bytes_received(self):
+        responses.add(responses.GET, 'https://myserver/artifactory/myrepo1/mysubdir/art1.zip',
+                      body='x' * 100, status=200)
+        elapsed, latencies, errors, received = self.jfi.probe(['myrepo1/mysubdir/art1.zip'], 1)
+        assert (len(latencies), errors, received) == (1, 0, 100)
+
+    def test_plan_delete_halves_throughput(self):
+        self.jfi.probe = Mock(return_value=(1.0, [0.1] * 5, 0, 0))
+        artifacts = [f'myrepo1/mysubdir/art{i}.zip' for i in range(10)]
+        ret = self.jfi.plan(iter(artifacts), 1, samples=5, delete=True)
+        assert ret['throughput'] == {1: 2.5}
+        assert ret['projected_seconds'] == 4.0
+
+    def test_plan_delete_probes_stats_and_counts_two_requests_per_artifact(self):
+        self.jfi.get_stats = Mock(return_value=None)
+        self.jfi.get_trace = Mock()
+        artifacts = [f'myrepo1/mysubdir/art{i}.zip' for i in range(10)]
+        ret = self.jfi.plan(iter(artifacts), 1, samples=5, delete=True)
+        assert ret['requests'] == 20
+        assert ret['error_rate'] == 1
+        self.jfi.get_trace.assert_not_called()
+
+    def test_init_does_not_add_handlers_repeatedly(self):
+        before = len(self.jfi.logger.handlers)
+        jfintegrity.jfIntegrity(server='https://myserver', access_token='myaccesstoken')
+        jfintegrity.jfIntegrity(server='https://myserver', access_token='myaccesstoken')
+        assert len(self.jfi.logger.handlers) == before == 1
+
+    def test_json_formatter_writes_one_object_per_record(self):
+        record = logging.LogRecord('logger', logging.INFO, __file__, 1, 'traced %s', ('myartifact.zip',), None)
+        ret = json.loads(helpers.JsonFormatter().format(record))
+        assert ret['level'] == 'INFO'
+        assert ret['message'] == 'traced myartifact.zip'
+
+    def test_queue_handler_keeps_exception_for_json_formatter(self):
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            record = logging.LogRecord('logger', logging.ERROR, __file__, 1, 'failed %s', ('myartifact.zip',), sys.exc_info())
+        prepared = helpers.ExceptionQueueHandler(None).prepare(record)
+        ret = json.loads(helpers.JsonFormatter().format(prepared))
+        assert ret['message'] == 'failed myartifact.zip'
+        assert 'ValueError: boom' in ret['exception']
+        text = logging.Formatter(helpers.LOG_FORMAT).format(prepared)
+        assert 'ValueError: boom' in text
+
+    def test_batch_file_handler_flushes_on_timer(self):
+        with tempfile.TemporaryDirectory() as d:
+            file = os.path.join(d, 'log')
+            handler = helpers.BatchFileHandler(file, batch=100, interval=0.05)
+            handler.emit(logging.LogRecord('logger', logging.INFO, __file__, 1, 'message', None, None))
+            time.sleep(0.3)
+            with open(file) as f:
+                assert f.read() == 'message\n'
+            handler.close()
+
+    def test_batch_file_handler_flushes_on_batch(self):
+        with tempfile.TemporaryDirectory() as d:
+            file = os.path.join(d, 'log')
+            handler = helpers.BatchFileHandler(file, batch=2, interval=60)
+            record = logging.LogRecord('logger', logging.INFO, __file__, 1, 'message', None, None)
+            handler.emit(record)
+            assert handler.pending == 1
+            handler.emit(record)
+            assert handler.pending == 0
+            with open(file) as f:
+                assert f.read() == 'message\nmessage\n'
+            handler.close()
+
+    def test_stratified_sample_takes_n_per_repo(self):
+        artifacts = [f'myrepo1/mysubdir/art{i}.zip' for i in range(10)] + ['myrepo2/mysubdir/art1.zip']
+        counts, samples = self.jfi.stratified_sample(artifacts, n=3)
+        assert counts == {'myrepo1': 10, 'myrepo2': 1}
+        assert len(samples['myrepo1']) == 3
+        assert len(set(samples['myrepo1'])) == 3
+        assert samples['myrepo2'] == ['myrepo2/mysubdir/art1.zip']
+
+    def test_stratified_sample_rate_bounds(self):
+        artifacts = [f'myrepo1/mysubdir/art{i}.zip' for i in range(10)]
+        counts, samples = self.jfi.stratified_sample(artifacts, rate=1.0)
+        assert samples['myrepo1'] == artifacts
+        counts, samples = self.jfi.stratified_sample(artifacts, rate=0.0)
+        assert samples['myrepo1'] == []
+
+    def test_estimate_reports_rate_interval_and_bad_paths(self):
+        counts = {'myrepo1': 100, 'myrepo2': 50}
+        results = [('myrepo1/mysubdir/art1.zip', jfintegrity.ARTIFACT_BAD),
+                   ('myrepo1/mysubdir/art2.zip', jfintegrity.ARTIFACT_GOOD),
+                   ('myrepo1/mysubdir/art3.zip', jfintegrity.ARTIFACT_GOOD),
+                   ('myrepo1/mysubdir/art4.zip', jfintegrity.ARTIFACT_GOOD),
+                   ('myrepo2/mysubdir/art1.zip', jfintegrity.ARTIFACT_UNKNOWN)]
+        ret = self.jfi.estimate(counts, results)
+        assert ret['myrepo1']['rate'] == 0.25
+        assert ret['myrepo1']['low'] < 0.25 < ret['myrepo1']['high']
+        assert ret['myrepo1']['bad'] == ['myrepo1/mysubdir/art1.zip']
+        assert ret['myrepo2']['rate'] is None
+        assert ret['myrepo2']['failures'] == 1
+
+    def test_wilson_interval(self):
+        low, high = helpers.wilson_interval(0, 0)
+        assert (low, high) == (0.0, 1.0)
+        low, high = helpers.wilson_interval(10, 100)
+        assert round(low, 4) == 0.0552
+        assert round(high, 4) == 0.1744
+
+    def test_wilson_interval_finite_population(self):
+        assert helpers.wilson_interval(10, 100, population=100) == (0.1, 0.1)
+        low, high = helpers.wilson_interval(10, 100, population=200)
+        assert 0.0552 < low < 0.1 < high < 0.1744
+
+    def test_estimate_full_sample_reports_exact_rate(self):
+        results = [('myrepo1/mysubdir/art1.zip', jfintegrity.ARTIFACT_BAD),
+                   ('myrepo1/mysubdir/art2.zip', jfintegrity.ARTIFACT_GOOD)]
+        ret = self.jfi.estimate({'myrepo1': 2}, results)
+        assert (ret['myrepo1']['low'], ret['myrepo1']['high']) == (0.5, 0.5)
+
+    def test_listing_is_sorted_records(self):
+        self.jfi.get_contents = Mock(return_value=json.loads(get_contents))
+        ret = self.jfi.listing('myrepo1', '2023-01-01')
+        assert ret == [('myrepo1/mysubdir/art1.zip', '64ccb1f7564bf678ba0f6c93c46b188f70fb5ea49064b23d74259a47fef45c08', 192000, '2023-01-10T17:00:00.235Z'),
+                       ('myrepo1/mysubdir/art3.zip', 'ac577492d275c5c5454fb1ef598e9fb33b7677cad4bfc7ce0d17fcd3b76f209c', 1934, '2023-02-10T17:00:00.666Z')]
+
+    def test_diff_listings_reports_missing_extra_and_divergent(self):
+        primary = [('r/a', 'x', 1, 't'), ('r/b', 'x', 1, 't'), ('r/c', 'x', 1, 't')]
+        other = [('r/b', 'y', 1, 't'), ('r/c', 'x', 1, 't'), ('r/d', 'x', 1, 't')]
+        ret = list(self.jfi.diff_listings(primary, other))
+        assert ret == [('r/a', jfintegrity.ARTIFACT_MISSING), ('r/b', jfintegrity.ARTIFACT_DIVERGENT),
+                       ('r/d', jfintegrity.ARTIFACT_EXTRA)]
+
+    def test_compare_lists_each_repo_on_every_instance(self):
+        peer = jfintegrity.jfIntegrity(server='https://mydr', access_token='myaccesstoken')
+        self.jfi.get_contents = Mock(side_effect=self.side_effect_get_contents_multiple_calls)
+        peer.get_contents = Mock(return_value=json.loads(get_contents2))
+        ret = list(self.jfi.compare([peer], ['myrepo1']))
+        assert [(path, result) for p, path, result in ret] == [('myrepo1/mysubdir/art2.zip', jfintegrity.ARTIFACT_MISSING),
+                                                               ('myrepo1/mysubdir/art3.zip', jfintegrity.ARTIFACT_MISSING),
+                                                               ('myrepo1/mysubdir/art4.zip', jfintegrity.ARTIFACT_EXTRA),
+                                                               ('myrepo1/mysubdir/art5.zip', jfintegrity.ARTIFACT_EXTRA)]
+        peer.get_contents.assert_called_once_with('myrepo1')
+
+    def test_compare_skips_repo_that_failed_to_list(self):
+        peer = jfintegrity.jfIntegrity(server='https://mydr', access_token='myaccesstoken')
+        self.jfi.get_contents = Mock(side_effect=self.side_effect_get_contents_multiple_calls)
+        peer.get_contents = Mock(side_effect=lambda repo: None if repo == 'myrepo1' else json.loads(get_contents2))
+        ret = list(self.jfi.compare([peer], ['myrepo1', 'myrepo2']))
+        assert ret == []
+        self.jfi.get_contents = Mock(return_value=None)
+        assert list(self.jfi.compare([peer], ['myrepo2'])) == []
+
+    @responses.activate
+    def test_get_trace_sends_timeouts(self):
+        responses.add(responses.GET, 'https://myserver/artifactory/myrepo/mysubdir/myartifact.zip?skipUpdateStats=true&trace=null', body=trace_body, status=200)
+        self.jfi.get_trace('myrepo/mysubdir/myartifact.zip')
+        assert responses.calls[0].request.req_kwargs['timeout'] == (10, 300)
+
+    def test_request_timeout_is_shortened_to_deadline(self):
+        self.jfi.set_deadline(5)
+        connect, read = self.jfi.request_timeout()
+        assert connect <= 5 and read <= 5
+
+    @responses.activate
+    def test_get_trace_after_deadline_returns_none(self):
+        self.jfi.set_deadline(-1)
+        ret = self.jfi.get_trace('myrepo/mysubdir/myartifact.zip')
+        assert ret is None
+        assert len(responses.calls) == 0
+
+    def test_http_get_hedges_slow_request(self):
+        self.jfi.hedge = True
+        self.jfi.latency['trace'] = helpers.LatencyTracker(min_samples=1)
+        self.jfi.latency['trace'].add(0.01)
+        slow = Mock(name='slow')
+        fast = Mock(name='fast')
+        calls = []
+
+        def side_effect(kind, url, params=None, timeout=None):
+            calls.append(url)
+            if len(calls) == 1:
+                time.sleep(0.5)
+                return slow
+            return fast
+
+        self.jfi.timed_get = Mock(side_effect=side_effect)
+        ret = self.jfi.http_get('trace', 'https://myserver/artifactory/myrepo/mysubdir/myartifact.zip')
+        assert ret is fast
+        assert len(calls) == 2
+
+    def test_is_folder_no_stats_returns_none(self):
+        self.jfi.get_stats = Mock(return_value=None)
+        ret = self.jfi.is_folder('myrepo/mysubdir/myartifact.zip')
+        assert ret is None
+
+    @responses.activate
+    def test_del_artifact_after_deadline_is_not_deleted(self):
+        jfintegrity.output = []
+        self.jfi.set_deadline(-1)
+        self.jfi.del_artifact('myrepo/mysubdir/myartifact.zip')
+        assert jfintegrity.output == [('myrepo/mysubdir/myartifact.zip', 'artifact_not_deleted')]
+        assert len(responses.calls) == 0
+
+    def test_http_get_does_not_hedge_when_slots_are_full(self):
+        self.jfi.hedge = True
+        self.jfi.hedge_slots = threading.Semaphore(0)
+        self.jfi.latency['trace'] = helpers.LatencyTracker(min_samples=1)
+        self.jfi.latency['trace'].add(0.01)
+        response = Mock()
+        self.jfi.timed_get = Mock(return_value=response)
+        ret = self.jfi.http_get('trace', 'https://myserver/artifactory/myrepo/mysubdir/myartifact.zip')
+        assert ret is response
+        self.jfi.timed_get.assert_called_once()
+
+    def test_http_get_hedge_releases_slot_and_closes_loser(self):
+        self.jfi.hedge = True
+        self.jfi.hedge_slots = threading.Semaphore(1)
+        self.jfi.latency['trace'] = helpers.LatencyTracker(min_samples=1)
+        self.jfi.latency['trace'].add(0.01)
+        slow = Mock(name='slow')
+        fast = Mock(name='fast')
+        timeouts = []
+
+        def side_effect(kind, url, params=None, timeout=None):
+            timeouts.append(timeout)
+            if len(timeouts) == 1:
+                time.sleep(0.2)
+                return slow
+            return fast
+
+        self.jfi.timed_get = Mock(side_effect=side_effect)
+        ret = self.jfi.http_get('trace', 'https://myserver/artifactory/myrepo/mysubdir/myartifact.zip')
+        assert ret is fast
+        assert timeouts[1] == (1.0, 1.0)
+        assert self.jfi.hedge_slots.acquire(timeout=1)
+        slow.close.assert_called_once()
+
+    def test_http_get_does_not_hedge_past_deadline(self):
+        self.jfi.hedge = True
+        self.jfi.hedge_slots = threading.Semaphore(1)
+        self.jfi.latency['trace'] = helpers.LatencyTracker(min_samples=1)
+        self.jfi.latency['trace'].add(0.1)
+        self.jfi.set_deadline(0.05)
+        slow = Mock(name='slow')
+
+        def side_effect(kind, url, params=None, timeout=None):
+            time.sleep(0.3)
+            return slow
+
+        self.jfi.timed_get = Mock(side_effect=side_effect)
+        ret = self.jfi.http_get('trace', 'https://myserver/artifactory/myrepo/mysubdir/myartifact.zip')
+        assert ret is slow
+        assert self.jfi.timed_get.call_count == 1
+        assert self.jfi.hedge_slots.acquire(timeout=1)
+        slow.close.assert_not_called()
+
+    def test_snapshot_round_trip(self):
+        with tempfile.TemporaryDirectory() as d:
+            file = os.path.join(d, 'myrepo.tsv.gz')
+            records = [('/mysubdir/art1.zip', '2023-01-10T17:00:00.235Z', 192000, 'abc'), ('/art2.zip', '2023-01-10T17:00:00.235Z', None, None)]
+            helpers.write_snapshot(file, {'repo': 'myrepo'}, records)
+            meta, ret = helpers.read_snapshot(file)
+            assert meta == {'repo': 'myrepo'}
+            assert list(ret) == records
+
+    def test_snapshot_files_relists_only_changed_folders(self):
+        with tempfile.TemporaryDirectory() as d:
+            self.jfi.snapshot_dir = d
+            last_modified = {'myrepo1': '2023-02-10T17:00:00.666Z', 'myrepo1/mysubdir': '2023-02-10T17:00:00.666Z',
+                             'myrepo1/other': '2021-12-10T17:00:00.000Z'}
+            self.jfi.get_last_modified = Mock(side_effect=lambda path: last_modified[path])
+            self.jfi.get_children = Mock(return_value={'files': [{'uri': '/mysubdir', 'folder': True},
+                                                                  {'uri': '/other', 'folder': True}]})
+            self.jfi.get_contents = Mock(return_value=json.loads(get_contents))
+
+            ret = list(self.jfi.snapshot_files('myrepo1'))
+            assert [art['uri'] for art in ret] == ['/mysubdir/art1.zip', '/mysubdir/art2.zip', '/mysubdir/art3.zip']
+            assert self.jfi.get_contents.call_count == 1
+
+            self.jfi.get_children.reset_mock()
+            ret = list(self.jfi.snapshot_files('myrepo1'))
+            assert len(ret) == 3
+            self.jfi.get_children.assert_not_called()
+            assert self.jfi.get_contents.call_count == 1
+
+            last_modified['myrepo1'] = last_modified['myrepo1/mysubdir'] = '2023-03-01T00:00:00.000Z'
+            self.jfi.get_contents = Mock(return_value={'files': [{'uri': '/art4.zip', 'lastModified': '2023-03-01T00:00:00.000Z',
+                                                                  'size': 1, 'sha2': 'abc', 'folder': False}]})
+            ret = list(self.jfi.snapshot_files('myrepo1'))
+            self.jfi.get_contents.assert_called_once_with('myrepo1/mysubdir')
+            assert [art['uri'] for art in ret] == ['/mysubdir/art4.zip']
+
+    def test_refresh_snapshot_checks_folders_in_a_bounded_pool(self):
+        with tempfile.TemporaryDirectory() as d:
+            self.jfi.snapshot_dir = d
+            self.jfi.crawl_per_repo = 2
+            lock = threading.Lock()
+            running = [0, 0]
+
+            def last_modified(path):
+                with lock:
+                    running[0] += 1
+                    running[1] = max(running)
+                time.sleep(0.05)
+                with lock:
+                    running[0] -= 1
+                return '2023-02-10T17:00:00.666Z'
+
+            self.jfi.get_last_modified = Mock(side_effect=last_modified)
+            self.jfi.get_children = Mock(return_value={'files': [{'uri': f'/dir{i}', 'folder': True} for i in range(5)]})
+            self.jfi.list_records = Mock(return_value=[])
+            self.jfi.refresh_snapshot('myrepo1')
+            meta, records = helpers.read_snapshot(self.jfi.snapshot_path('myrepo1'))
+            assert meta['folders'] == {f'dir{i}': '2023-02-10T17:00:00.666Z' for i in range(5)}
+            assert running[1] == 2
+
+    @responses.activate
+    def test_get_children_tracks_its_own_latency(self):
+        responses.add(responses.GET, 'https://myserver/artifactory/api/storage/myrepo1', json={'files': []}, status=200)
+        self.jfi.get_children('myrepo1')
+        assert 'children' in self.jfi.latency
+        assert 'contents' not in self.jfi.latency
+
+    def test_compare_with_snapshots_keeps_servers_apart(self):
+        peer = jfintegrity.jfIntegrity(server='https://mydr', access_token='myaccesstoken')
+        files = {'https://myserver': [{'uri': '/a', 'lastModified': '2023-01-10T17:00:00.235Z', 'size': 1, 'sha2': 'x', 'folder': False},
+                                      {'uri': '/b', 'lastModified': '2023-01-10T17:00:00.235Z', 'size': 1, 'sha2': 'x', 'folder': False}],
+                 'https://mydr': [{'uri': '/a', 'lastModified': '2023-01-10T17:00:00.235Z', 'size': 1, 'sha2': 'x', 'folder': False}]}
+        with tempfile.TemporaryDirectory() as d:
+            for instance in (self.jfi, peer):
+                instance.snapshot_dir = d
+                instance.get_last_modified = Mock(return_value='2023-01-10T17:00:00.235Z')
+                instance.get_children = Mock(return_value={'files': files[instance.server]})
+                instance.get_contents = Mock(return_value={'files': files[instance.server]})
+            ret = list(self.jfi.compare([peer], ['myrepo']))
+            assert [(p.server, path, result) for p, path, result in ret] == [('https://mydr', 'myrepo/b', jfintegrity.ARTIFACT_MISSING)]
+            assert self.jfi.snapshot_path('myrepo') != peer.snapshot_path('myrepo')
+            assert sorted(os.listdir(d)) == ['mydr', 'myserver']
+
+    def test_cat_artifacts_reads_snapshot(self):
+        self.jfi.snapshot_dir = 'snapshots'
+        self.jfi.get_contents = Mock()
+        self.jfi.snapshot_files = Mock(return_value=iter(json.loads(get_contents)['files']))
+        ret = self.jfi.cat_artifacts(['myrepo1'], '2023-01-01')
+        assert ret == ['myrepo1/mysubdir/art1.zip', 'myrepo1/mysubdir/art3.zip']
+        self.jfi.get_contents.assert_not_called()
+
+    def side_effect_get_children_tree(self, path):
+        tree = {'myrepo1': [{'uri': '/mysubdir', 'folder': True}, {'uri': '/art0.zip', 'folder': False, 'lastModified': '2021-12-10T17:00:00.000Z'}],
+                'myrepo1/mysubdir': [{'uri': '/art1.zip', 'folder': False, 'lastModified': '2023-01-10T17:00:00.235Z'},
+                                     {'uri': '/deeper', 'folder': True}],
+                'myrepo1/mysubdir/deeper': [{'uri': '/art2.zip', 'folder': False, 'lastModified': '2023-02-10T17:00:00.666Z'}],
+                'myrepo2': [{'uri': '/art3.zip', 'folder': False, 'lastModified': '2023-02-10T17:00:00.666Z'}]}
+        if path in tree:
+            return {'files': tree[path]}
+
+    def test_crawl_walks_folders_of_every_repo(self):
+        self.jfi.crawl_threads = 4
+        self.jfi.get_children = Mock(side_effect=self.side_effect_get_children_tree)
+        ret = self.jfi.cat_artifacts(['myrepo1', 'myrepo2', 'myrepo3'], None)
+        assert sorted(ret) == ['myrepo1/art0.zip', 'myrepo1/mysubdir/art1.zip', 'myrepo1/mysubdir/deeper/art2.zip', 'myrepo2/art3.zip']
+        assert self.jfi.get_children.call_count == 5
+
+    def test_crawl_does_not_park_threads_on_a_capped_repo(self):
+        self.jfi.crawl_threads = 4
+        self.jfi.crawl_per_repo = 1
+        release = threading.Event()
+
+        def side_effect(path):
+            if path == 'bigrepo':
+                return {'files': [{'uri': f'/dir{i}', 'folder': True} for i in range(4)]}
+            if path.startswith('bigrepo/'):
+                release.wait(2)
+                return {'files': []}
+            if path == 'smallrepo':
+                time.sleep(0.1)
+                return {'files': [{'uri': '/sub', 'folder': True}]}
+            release.set()
+            return {'files': [{'uri': '/art1.zip', 'folder': False, 'lastModified': '2023-01-10T17:00:00.235Z'}]}
+
+        self.jfi.get_children = Mock(side_effect=side_effect)
+        start = time.monotonic()
+        ret = list(self.jfi.crawl(['bigrepo', 'smallrepo']))
+        assert ret == ['smallrepo/sub/art1.zip']
+        assert time.monotonic() - start < 1.5
+
+    def test_crawl_with_after_returns_expected_items(self):
+        self.jfi.crawl_threads = 2
+        self.jfi.get_children = Mock(side_effect=self.side_effect_get_children_tree)
+        ret = self.jfi.crawl(['myrepo1'], '2023-01-01')
+        assert sorted(ret) == ['myrepo1/mysubdir/art1.zip', 'myrepo1/mysubdir/deeper/art2.zip']
+
+    def test_rollup_counts_per_repo_and_folder(self):
+        rollup = helpers.Rollup(depth=1)
+        rollup.add('myrepo1/mysubdir/deeper/art1.zip', jfintegrity.ARTIFACT_GOOD)
+        rollup.add('myrepo1/mysubdir/art2.zip', jfintegrity.ARTIFACT_BAD)
+        rollup.add('myrepo1/art3.zip', jfintegrity.ARTIFACT_BAD)
+        assert rollup.counts == {'myrepo1': {'artifact_traceable': 1, 'artifact_untraceable': 2},
+                                 'myrepo1/mysubdir': {'artifact_traceable': 1, 'artifact_untraceable': 1}}
+        tree = rollup.tree()
+        assert tree['myrepo1']['children']['mysubdir']['counts'] == {'artifact_traceable': 1, 'artifact_untraceable': 1}
+        assert rollup.summary() == ('myrepo1: artifact_traceable=1, artifact_untraceable=2\n'
+                                    '  myrepo1/mysubdir: artifact_traceable=1, artifact_untraceable=1\n')
+
+    def test_rollup_summary_keeps_children_under_their_parent(self):
+        rollup = helpers.Rollup(depth=1)
+        rollup.add('lib/x/art1.zip', jfintegrity.ARTIFACT_GOOD)
+        rollup.add('lib-release/y/art2.zip', jfintegrity.ARTIFACT_BAD)
+        assert rollup.summary() == ('lib: artifact_traceable=1\n'
+                                    '  lib/x: artifact_traceable=1\n'
+                                    'lib-release: artifact_untraceable=1\n'
+                                    '  lib-release/y: artifact_untraceable=1\n')
+
+    def test_trace_updates_rollup(self):
+        jfintegrity.output = []
+        self.jfi.rollup = helpers.Rollup(depth=0)
+        self.jfi.get_trace = Mock(return_value=trace_body)
+        self.jfi.trace('myrepo/mysubdir/myartifact.zip')
+        assert self.jfi.rollup.counts == {'myrepo': {'artifact_traceable': 1}}
+
+    def side_effect_get_repository(self, repository):
+        configs = {'myvirtual': {'key': 'myvirtual', 'rclass': 'virtual', 'repositories': ['myrepo1', 'myvirtual2']},
+                   'myvirtual2': {'key': 'myvirtual2', 'rclass': 'virtual', 'repositories': ['myrepo2', 'myvirtual']},
+                   'myrepo1': {'key': 'myrepo1', 'rclass': 'local'},
+                   'myrepo2': {'key': 'myrepo2', 'rclass': 'local'}}
+        return configs.get(repository)
+
+    def test_resolve_repos_lists_each_physical_repo_once(self):
+        self.jfi.get_repository = Mock(side_effect=self.side_effect_get_repository)
+        ret = self.jfi.resolve_repos(['myvirtual', 'myrepo1'])
+        assert ret == ['myrepo1', 'myrepo2']
+        assert self.jfi.aliases == {'myrepo1': ['myvirtual', 'myrepo1'], 'myrepo2': ['myvirtual']}
+
+    def test_compile_artifacts_resolve_virtual_traces_once_reports_under_each_name(self):
+        jfintegrity.output = []
+        self.jfi.resolve_virtual = True
+        self.jfi.get_repository = Mock(side_effect=self.side_effect_get_repository)
+        self.jfi.cat_artifacts = Mock(side_effect=self.side_effect_cat_artifacts_multiple_calls)
+        ret = list(self.jfi.compile_artifacts(repos=['myvirtual', 'myrepo1']))
+        self.jfi.cat_artifacts.assert_called_once_with(['myrepo1', 'myrepo2'], None)
+        assert len(ret) == 6
+        self.jfi.get_trace = Mock(return_value=trace_body)
+        self.jfi.trace('myrepo1/mysubdir/art1.zip')
+        self.jfi.trace('myrepo2/mysubdir/art4.zip')
+        assert self.jfi.get_trace.call_count == 2
+        assert jfintegrity.output == [('myrepo1/mysubdir/art1.zip', 'artifact_traceable'),
+                                      ('myvirtual/mysubdir/art1.zip', 'artifact_traceable'),
+                                      ('myrepo2/mysubdir/art4.zip', 'artifact_traceable'),
+                                      ('myvirtual/mysubdir/art4.zip', 'artifact_traceable')]
+
+    def test_resolve_virtual_keeps_afile_path(self):
+        jfintegrity.output = []
+        self.jfi.resolve_virtual = True
+        self.jfi.get_repository = Mock(side_effect=self.side_effect_get_repository)
+        self.jfi.cat_artifacts = Mock(return_value=[])
+        self.jfi.read_items = Mock(return_value=['myrepo2/x.zip'])
+        ret = list(self.jfi.compile_artifacts(repos=['myvirtual'], afile='afile'))
+        assert ret == ['myrepo2/x.zip']
+        self.jfi.get_trace = Mock(return_value=trace_body)
+        self.jfi.trace('myrepo2/x.zip')
+        assert ('myrepo2/x.zip', 'artifact_traceable') in jfintegrity.output
+
+    @responses.activate
+    def test_get_repository_ok(self):
+        body = '{"key": "myvirtual", "rclass": "virtual", "repositories": ["myrepo1"]}'
+        responses.add(responses.GET, 'https://myserver/artifactory/api/repositories/myvirtual', body=body, status=200)
+        ret = self.jfi.get_repository('myvirtual')
+        assert ret == json.loads(body)